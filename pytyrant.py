@@ -23,16 +23,39 @@ for the raw Tyrant protocol::
     >>> del t['__test_key__']
 
 """
+import array
+import contextlib
+import functools
+import hashlib
+import heapq
 import itertools
+import marshal
 import math
 import socket
 import struct
+import sys
+import threading
+import time
 import UserDict
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
 
 __version__ = '1.1.17'
 
 __all__ = [
-    'Tyrant', 'TyrantError', 'PyTyrant',
+    'Tyrant', 'TyrantError', 'TyrantConnectionError', 'CircuitOpenError',
+    'CircuitBreaker', 'Coalescer', 'PyTyrant', 'ShardedQuery', 'BloomFilter',
+    'Serializer', 'RawSerializer', 'MarshalSerializer', 'PickleSerializer',
+    'JSONSerializer', 'register_serializer', 'compare_serializers',
     'RDBMONOULOG', 'RDBXOLCKREC', 'RDBXOLCKGLB',
 ]
 
@@ -40,9 +63,21 @@ class TyrantError(Exception):
     pass
 
 
+class TyrantConnectionError(socket.error):
+    """The connection to the server was lost"""
+
+
+class CircuitOpenError(TyrantConnectionError):
+    """The server is considered down, the call was not attempted"""
+
+
 DEFAULT_PORT = 1978
 MAGIC = 0xc8
 
+# Number of commands written before their responses are read when
+# pipelining, so neither side's socket buffers can fill up and deadlock
+PIPELINE_SIZE = 1024
+
 
 RDBMONOULOG = 1 << 0
 RDBXOLCKREC = 1 << 0
@@ -181,7 +216,10 @@ def socksend(sock, lst):
 def sockrecv(sock, bytes):
     d = ''
     while len(d) < bytes:
-        d += sock.recv(min(8192, bytes - len(d)))
+        chunk = sock.recv(min(8192, bytes - len(d)))
+        if not chunk:
+            raise TyrantConnectionError('Connection closed by server')
+        d += chunk
     return d
 
 
@@ -216,6 +254,415 @@ def sockstrpair(sock):
     return k, v
 
 
+_POPCOUNT = [bin(i).count('1') for i in xrange(256)]
+
+
+class BloomFilter(object):
+    """
+    Client-side Bloom filter over a set of keys
+
+    Membership tests never give false negatives, so a key that is not in
+    the filter is definitely not in the database.
+
+    >>> bloom = BloomFilter(1000, error_rate=0.01)
+    >>> for i in xrange(1000):
+    ...     bloom.add('key%d' % (i,))
+    >>> all(('key%d' % (i,)) in bloom for i in xrange(1000))
+    True
+    >>> measured = sum(('other%d' % (i,)) in bloom
+    ...     for i in xrange(20000)) / 20000.0
+    >>> abs(bloom.false_positive_rate() - measured) < 0.005
+    True
+    >>> bloom.false_positive_rate() < 0.015
+    True
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2))), 8)
+        self.num_hashes = max(
+            int(round(self.num_bits * math.log(2) / capacity)), 1)
+        self.bits = array.array('B', [0]) * ((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        num_bits = self.num_bits
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(key).digest())
+        # A step that is a multiple of num_bits would put every hash on
+        # the same bit
+        h2 = h2 % (num_bits - 1) + 1
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % num_bits
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def false_positive_rate(self):
+        """Estimate the probability that an absent key tests present,
+        based on the fraction of bits currently set
+        """
+        filled = sum(_POPCOUNT[b] for b in self.bits)
+        return (filled / float(self.num_bits)) ** self.num_hashes
+
+
+class DeadlineSocket(object):
+    """
+    Socket wrapper that bounds a command by a deadline (an absolute
+    time.time() value, or None to block)
+
+    With a deadline the socket timeout is clamped to the time left before
+    every send and recv, so a command can't overrun it however slowly the
+    server replies. Without one sendall and recv are the socket's own
+    methods and the socket is left blocking.
+
+    >>> ours, theirs = socket.socketpair()
+    >>> sock = DeadlineSocket(ours)
+    >>> sock.set_deadline(time.time() + 0.1)
+    >>> sockrecv(sock, 1)
+    Traceback (most recent call last):
+    ...
+    timeout: timed out
+
+    A server trickling its reply can't stretch the deadline:
+
+    >>> def trickle():
+    ...     for c in 'abcde':
+    ...         time.sleep(0.06)
+    ...         theirs.sendall(c)
+    >>> thread = threading.Thread(target=trickle)
+    >>> thread.start()
+    >>> start = time.time()
+    >>> sock.set_deadline(start + 0.1)
+    >>> sockrecv(sock, 5)
+    Traceback (most recent call last):
+    ...
+    timeout: timed out
+    >>> time.time() - start < 0.15
+    True
+    >>> thread.join()
+    >>> sock.set_deadline(None)
+    >>> sockrecv(sock, 4), ours.gettimeout()
+    ('bcde', None)
+
+    A closed connection is reported instead of read as endless empty data:
+
+    >>> theirs.sendall('xy')
+    >>> theirs.close()
+    >>> sockrecv(sock, 3)
+    Traceback (most recent call last):
+    ...
+    TyrantConnectionError: Connection closed by server
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.deadline = None
+        self.blocking = sock.gettimeout() is None
+        self.sendall = sock.sendall
+        self.recv = sock.recv
+
+    def set_deadline(self, deadline):
+        if deadline is None:
+            if self.deadline is not None:
+                self.deadline = None
+                self.sendall = self.sock.sendall
+                self.recv = self.sock.recv
+            if not self.blocking:
+                self.sock.settimeout(None)
+                self.blocking = True
+            return
+        if self.deadline is None:
+            self.sendall = self._sendall
+            self.recv = self._recv
+        self.deadline = deadline
+
+    def _clamp(self):
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout('Deadline exceeded')
+        self.sock.settimeout(remaining)
+        self.blocking = False
+
+    def _sendall(self, data):
+        self._clamp()
+        self.sock.sendall(data)
+
+    def _recv(self, bufsize):
+        self._clamp()
+        return self.sock.recv(bufsize)
+
+    def close(self):
+        self.sock.close()
+
+
+class CircuitBreaker(object):
+    """
+    Fails calls to a server fast while it is down
+
+    After failure_threshold consecutive connection failures the circuit
+    opens and calls raise CircuitOpenError without touching the network.
+    Every reset_timeout seconds one call is let through to probe the
+    server, and the circuit closes again as soon as a call succeeds. A
+    breaker may be shared by all the connections to one server.
+
+    >>> breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    >>> breaker.failure()
+    >>> breaker.is_open()
+    False
+    >>> breaker.failure()
+    >>> breaker.is_open()
+    True
+    >>> breaker.before_call()
+    Traceback (most recent call last):
+    ...
+    CircuitOpenError: Circuit open after 2 failures
+    >>> time.sleep(0.1)
+    >>> breaker.before_call()
+    >>> breaker.before_call()
+    Traceback (most recent call last):
+    ...
+    CircuitOpenError: Circuit open after 2 failures
+    >>> breaker.success()
+    >>> breaker.is_open()
+    False
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_call(self):
+        self.lock.acquire()
+        try:
+            if self.opened_at is None:
+                return
+            now = time.time()
+            if now - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError('Circuit open after %d failures'
+                    % (self.failures,))
+            # Let this call probe the server, everyone else keeps failing
+            # fast until it reports back or another reset_timeout passes
+            self.opened_at = now
+        finally:
+            self.lock.release()
+
+    def success(self):
+        self.lock.acquire()
+        try:
+            self.failures = 0
+            self.opened_at = None
+        finally:
+            self.lock.release()
+
+    def failure(self):
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+        finally:
+            self.lock.release()
+
+
+class _Batch(object):
+    def __init__(self):
+        self.keys = []
+        self.pending = set()
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+    def run(self, load):
+        try:
+            self.results = load(self.keys)
+        except:
+            self.error = sys.exc_info()
+        self.done.set()
+
+
+class Coalescer(object):
+    """
+    Merges single key lookups made concurrently by several threads into
+    one call to load(keys), which returns a dict of the keys found
+
+    The first thread to ask for a key waits up to window seconds, or
+    until max_batch distinct keys are pending, then loads the batch for
+    every waiting thread. Each key is loaded once per batch however many
+    threads asked for it.
+
+    >>> loaded = []
+    >>> def load(keys):
+    ...     loaded.append(keys)
+    ...     return dict((key, key.upper()) for key in keys if key != 'nokey')
+    >>> coalescer = Coalescer(load, window=0.5, max_batch=3)
+    >>> results = {}
+    >>> def get(coalescer, key):
+    ...     try:
+    ...         value = coalescer.get(key)
+    ...     except Exception, e:
+    ...         value = e
+    ...     results.setdefault(key, []).append(value)
+    >>> def get_all(coalescer, keys):
+    ...     threads = []
+    ...     for key in keys:
+    ...         thread = threading.Thread(target=get, args=(coalescer, key))
+    ...         thread.start()
+    ...         threads.append(thread)
+    ...         time.sleep(0.02)
+    ...     for thread in threads:
+    ...         thread.join()
+    >>> get_all(coalescer, ['a', 'a', 'nokey', 'nokey', 'b', 'c'])
+    >>> loaded
+    [['a', 'nokey', 'b'], ['c']]
+    >>> results['a'], results['b'], results['c']
+    (['A', 'A'], ['B'], ['C'])
+    >>> results['nokey']
+    [KeyError('nokey',), KeyError('nokey',)]
+
+    Errors raised by load reach every caller waiting on the batch:
+
+    >>> def broken(keys):
+    ...     raise ValueError('server down')
+    >>> results.clear()
+    >>> get_all(Coalescer(broken, window=0.5), ['x', 'y'])
+    >>> sorted(results.items())
+    [('x', [ValueError('server down',)]), ('y', [ValueError('server down',)])]
+    """
+    def __init__(self, load, window=0.001, max_batch=128):
+        self.load = load
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.batch = None
+
+    def get(self, key):
+        """Return the value loaded for key, raising KeyError if it was
+        not found
+        """
+        self.lock.acquire()
+        try:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = _Batch()
+            if key not in batch.pending:
+                batch.pending.add(key)
+                batch.keys.append(key)
+                if len(batch.keys) >= self.max_batch:
+                    self.batch = None
+                    batch.full.set()
+        finally:
+            self.lock.release()
+        if leader:
+            batch.full.wait(self.window)
+            self.lock.acquire()
+            try:
+                if self.batch is batch:
+                    self.batch = None
+            finally:
+                self.lock.release()
+            batch.run(self.load)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            _reraise(*batch.error)
+        try:
+            return batch.results[key]
+        except KeyError:
+            raise KeyError(key)
+
+
+class _LockedTyrant(object):
+    """
+    Proxy for a Tyrant that lets one thread at a time call its methods
+    """
+    def __init__(self, t):
+        self._t = t
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._t, name)
+        if not callable(attr):
+            return attr
+        lock = self._lock
+
+        def locked(*args, **kw):
+            lock.acquire()
+            try:
+                return attr(*args, **kw)
+            finally:
+                lock.release()
+        setattr(self, name, locked)
+        return locked
+
+
+def _command(idempotent=False):
+    """Run a Tyrant method through Tyrant._call
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kw):
+            return self._call(idempotent, method, self, *args, **kw)
+        return wrapper
+    return decorator
+
+
+# misc functions that are safe to retry after a reconnect
+IDEMPOTENT_MISC = frozenset(['get', 'getlist', 'search'])
+
+
+# The three argument raise keeps the original traceback, it is compiled
+# at import time so the module still parses under Python 3
+exec("def _reraise(tp, value, tb):\n    raise tp, value, tb\n")
+
+
+def _parallel(func, argslist):
+    """Call func(*args) for each args in argslist, each in its own thread,
+    and return the results in order. The first exception raised is re-raised
+    once every call has finished.
+    """
+    if len(argslist) == 1:
+        return [func(*argslist[0])]
+    results = [None] * len(argslist)
+    errors = []
+
+    def run(i, args):
+        try:
+            results[i] = func(*args)
+        except:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=run, args=(i, args))
+        for i, args in enumerate(argslist)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        _reraise(*errors[0])
+    return results
+
+
 def dict_to_list(dct):
     return list(itertools.chain(*dct.iteritems()))
 
@@ -226,26 +673,372 @@ def list_to_dict(lst):
     return dict((lst[i], lst[i + 1]) for i in xrange(0, len(lst), 2))
 
 
+_SERIALIZERS = {}
+
+
+def register_serializer(serializer):
+    """Reserve serializer's tag, so raw strings that start with it are
+    escaped, and include it in compare_serializers
+    """
+    _SERIALIZERS[serializer.tag] = serializer
+    return serializer
+
+
+class Serializer(object):
+    """
+    Base class for value serializers
+
+    Encoded values are prefixed with the serializer's one byte tag, so
+    values written in different formats can be mixed in one database.
+    A serializer only decodes its own format, raw strings, and the
+    formats of the serializer instances given in accept. Values tagged
+    with any other format are returned undecoded, so a serializer never
+    unpickles data unless pickle was chosen. A value in an accepted format
+    that fails to decode raises.
+
+    Subclasses implement _dumps and _loads and should be registered with
+    register_serializer. Serializers whose output may contain NUL bytes
+    must set binary, those can't be used for table columns.
+
+    Each instance keeps running counts and timings of the values it has
+    encoded and of the values in its own format it has decoded, see
+    stats.
+
+    >>> pickler = PickleSerializer()
+    >>> data = pickler.dumps({'a': [1, 2]})
+    >>> data[:1] == PickleSerializer.tag
+    True
+    >>> JSONSerializer().loads(data) == data
+    True
+    >>> JSONSerializer(accept=[pickler]).loads(data)
+    {'a': [1, 2]}
+    >>> pickler.loads_many([data, 'untagged'])
+    [{'a': [1, 2]}, 'untagged']
+    >>> pickler.stats()['dumps_count'], pickler.stats()['loads_count']
+    (1, 2)
+    >>> RawSerializer().dumps('\\x03tricky')
+    '\\x01\\x03tricky'
+    >>> RawSerializer().loads('\\x01\\x03tricky')
+    '\\x03tricky'
+
+    Untagged binary data is returned as is, even if it starts with the raw
+    tag, and corrupt data in an accepted format raises:
+
+    >>> RawSerializer().loads('\\x01binary')
+    '\\x01binary'
+    >>> JSONSerializer().loads('\\x04{') # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    ValueError: Expecting object
+    """
+    tag = None
+    name = None
+    binary = True
+
+    def __init__(self, accept=()):
+        self.dumps_count = 0
+        self.dumps_time = 0.0
+        self.loads_count = 0
+        self.loads_time = 0.0
+        self.bytes_out = 0
+        self.readers = {self.tag: self}
+        if self.tag != RawSerializer.tag:
+            self.readers[RawSerializer.tag] = RawSerializer()
+        for serializer in accept:
+            self.readers[serializer.tag] = serializer
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.stats())
+
+    def _dumps(self, obj):
+        raise NotImplementedError
+
+    def _loads(self, data):
+        raise NotImplementedError
+
+    def _dumps_many(self, objs):
+        tag, _dumps = self.tag, self._dumps
+        return [tag + _dumps(obj) for obj in objs]
+
+    def dumps(self, obj):
+        return self.dumps_many((obj,))[0]
+
+    def loads(self, data):
+        return self.loads_many((data,))[0]
+
+    def dumps_many(self, objs):
+        start = time.time()
+        rval = self._dumps_many(objs)
+        self.dumps_time += time.time() - start
+        self.dumps_count += len(rval)
+        self.bytes_out += sum(itertools.imap(len, rval))
+        return rval
+
+    def loads_many(self, datas):
+        rval = list(datas)
+        readers = self.readers
+        batches = {}
+        for i, data in enumerate(rval):
+            reader = readers.get(data[:1])
+            if reader is not None:
+                batches.setdefault(reader, []).append(i)
+        # Untagged values, and values in formats that weren't accepted,
+        # are returned as is
+        for reader, indexes in batches.iteritems():
+            _loads = reader._loads
+            start = time.time()
+            for i in indexes:
+                rval[i] = _loads(rval[i][1:])
+            reader.loads_time += time.time() - start
+            reader.loads_count += len(indexes)
+        return rval
+
+    def stats(self):
+        return {
+            'dumps_count': self.dumps_count,
+            'dumps_time': self.dumps_time,
+            'loads_count': self.loads_count,
+            'loads_time': self.loads_time,
+            'bytes_out': self.bytes_out,
+        }
+
+
+class RawSerializer(Serializer):
+    """
+    Passes strings through untouched
+
+    Only strings that happen to start with another serializer's tag get a
+    tag of their own, so raw values stay readable by other clients and
+    usable in table queries.
+    """
+    tag = '\x01'
+    name = 'raw'
+    binary = False
+
+    def _dumps_many(self, objs):
+        rval = []
+        for obj in objs:
+            if not isinstance(obj, str):
+                raise TypeError('%r is not a string' % (obj,))
+            rval.append(_escape(obj))
+        return rval
+
+    def _loads(self, data):
+        if data[:1] in _SERIALIZERS:
+            return data
+        # Only strings starting with a tag are escaped, so this is an
+        # untagged value that happens to start with the raw tag
+        return self.tag + data
+
+
+def _escape(data):
+    # Tag raw strings only when they could be mistaken for tagged data
+    if data[:1] in _SERIALIZERS:
+        return RawSerializer.tag + data
+    return data
+
+
+class MarshalSerializer(Serializer):
+    tag = '\x02'
+    name = 'marshal'
+
+    def _dumps(self, obj):
+        return marshal.dumps(obj)
+
+    def _loads(self, data):
+        return marshal.loads(data)
+
+
+class PickleSerializer(Serializer):
+    tag = '\x03'
+    name = 'pickle'
+
+    def _dumps(self, obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def _loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONSerializer(Serializer):
+    tag = '\x04'
+    name = 'json'
+    binary = False
+
+    def __init__(self, accept=()):
+        if json is None:
+            raise ImportError('JSONSerializer requires json or simplejson')
+        super(JSONSerializer, self).__init__(accept)
+
+    def _dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def _loads(self, data):
+        return json.loads(data)
+
+
+for _cls in (RawSerializer, MarshalSerializer, PickleSerializer):
+    register_serializer(_cls())
+if json is not None:
+    register_serializer(JSONSerializer())
+del _cls
+
+
+def compare_serializers(values, serializers=None):
+    """Encode and decode values with each serializer (by default all of
+    the registered ones) and return a list of
+    (name, dumps seconds, loads seconds, encoded bytes) tuples ordered from
+    cheapest to most expensive. Serializers that cannot represent the
+    values are left out.
+
+    >>> results = compare_serializers([{'id': i} for i in xrange(100)])
+    >>> sorted(name for name, dumps, loads, size in results)
+    ['json', 'marshal', 'pickle']
+    >>> sorted(name for name, dumps, loads, size in compare_serializers(['abc']))
+    ['json', 'marshal', 'pickle', 'raw']
+    """
+    if not isinstance(values, (list, tuple)):
+        values = list(values)
+    if serializers is None:
+        serializers = [s.__class__() for s in _SERIALIZERS.itervalues()]
+    results = []
+    for s in serializers:
+        before = s.stats()
+        try:
+            s.loads_many(s.dumps_many(values))
+        except (TypeError, ValueError, pickle.PicklingError):
+            continue
+        after = s.stats()
+        results.append((
+            s.name,
+            after['dumps_time'] - before['dumps_time'],
+            after['loads_time'] - before['loads_time'],
+            after['bytes_out'] - before['bytes_out']))
+    results.sort(key=lambda r: r[1] + r[2])
+    return results
+
+
+def _unpack_results(rval, count):
+    if isinstance(rval, Exception):
+        return [rval] * count
+    results = rval.split('\x00')
+    if len(results) != count:
+        return [TyrantError('Expected %d packed results, got %d'
+            % (count, len(results)))] * count
+    return results
+
+
+def _getlist_records(keys, rval):
+    """Map keys to their raw values in a getlist reply
+
+    Tyrant 1.1.11 replies with the keys and values of the records found,
+    interleaved. 1.1.10 replies with the values alone, which can only be
+    matched to keys when every key was found.
+
+    >>> sorted(_getlist_records(['a', 'b', 'c'], ['a', 'A', 'c', 'C']).items())
+    [('a', 'A'), ('c', 'C')]
+    >>> sorted(_getlist_records(['a', 'b'], ['A', 'B']).items())
+    [('a', 'A'), ('b', 'B')]
+    >>> _getlist_records(['a', 'b'], ['A'])
+    Traceback (most recent call last):
+    ...
+    KeyError: 'Missing a result, unusable response in 1.1.10'
+    """
+    if len(rval) % 2 == 0 and set(rval[::2]).issubset(keys):
+        return dict(itertools.izip(rval[::2], rval[1::2]))
+    if len(rval) != len(keys):
+        raise KeyError("Missing a result, unusable response in 1.1.10")
+    return dict(itertools.izip(keys, rval))
+
+
 class PyTyrant(object, UserDict.DictMixin):
     """
     Dict-like proxy for a Tyrant instance
     """
     @classmethod
     def open(cls, *args, **kw):
-        return cls(Tyrant.open(*args, **kw))
+        serializer = kw.pop('serializer', None)
+        return cls(Tyrant.open(*args, **kw), serializer=serializer)
 
-    def __init__(self, t):
+    def __init__(self, t, serializer=None):
         self.t = t
+        self.serializer = serializer
+        self.bloom = None
+        self._get_coalescer = None
+        self._size_coalescer = None
 
     def __repr__(self):
         # The __repr__ for UserDict.DictMixin isn't desirable
         # for a large KV store :)
         return object.__repr__(self)
 
+    def deadline(self, seconds):
+        return self.t.deadline(seconds)
+
+    def coalesce(self, window=0.001, max_batch=128):
+        """Merge concurrent __getitem__, get_size and `in` calls made from
+        several threads into one getlist or pipelined vsiz request, see
+        Coalescer. The connection is shared by every thread from then on,
+        so each call made through it holds a lock. Returns self.
+
+        >>> class SlowTyrant(object):
+        ...     # Records whether two calls ever ran at once
+        ...     def __init__(self):
+        ...         self.running = 0
+        ...         self.overlapped = False
+        ...     def _run(self):
+        ...         self.running += 1
+        ...         self.overlapped = self.overlapped or self.running > 1
+        ...         time.sleep(0.05)
+        ...         self.running -= 1
+        ...     def misc(self, func, opts, args):
+        ...         self._run()
+        ...         return [key.upper() for key in args]
+        ...     def put(self, key, value):
+        ...         self._run()
+        >>> t = PyTyrant(SlowTyrant()).coalesce(window=0.01)
+        >>> threads = [threading.Thread(target=t.__getitem__, args=('a',)),
+        ...     threading.Thread(target=t.__setitem__, args=('b', 'v'))]
+        >>> for thread in threads:
+        ...     thread.start()
+        >>> for thread in threads:
+        ...     thread.join()
+        >>> t.t.overlapped
+        False
+        >>> t['a']
+        'A'
+        """
+        if not isinstance(self.t, _LockedTyrant):
+            self.t = _LockedTyrant(self.t)
+        self._get_coalescer = Coalescer(self._load_values, window, max_batch)
+        self._size_coalescer = Coalescer(self._load_sizes, window, max_batch)
+        return self
+
+    def _decode_records(self, datas):
+        return self._decode_many(datas)
+
+    def _load_values(self, keys):
+        records = _getlist_records(keys, self.t.misc('getlist', 0, keys))
+        return dict(itertools.izip(
+            records.keys(), self._decode_records(records.values())))
+
+    def _load_sizes(self, keys):
+        sizes = self.t.multi_vsiz(keys)
+        return dict((key, size) for key, size in itertools.izip(keys, sizes)
+            if size is not None)
+
     def has_key(self, key):
         return key in self
 
     def __contains__(self, key):
+        if self.bloom is not None and key not in self.bloom:
+            return False
+        if self._size_coalescer is not None:
+            try:
+                self._size_coalescer.get(key)
+            except KeyError:
+                return False
+            return True
         try:
             self.t.vsiz(key)
         except TyrantError:
@@ -253,21 +1046,120 @@ class PyTyrant(object, UserDict.DictMixin):
         else:
             return True
 
+    def multi_contains(self, keys):
+        """Return a list of booleans telling whether each of keys exists.
+
+        Keys ruled out by the Bloom filter (see build_bloom) are never sent
+        to the server, the rest are checked with pipelined vsiz requests.
+
+        >>> class StubTyrant(object):
+        ...     def __init__(self, keys):
+        ...         self.keys = keys
+        ...         self.calls = []
+        ...     def rnum(self):
+        ...         return len(self.keys)
+        ...     def fwmkeys(self, prefix, maxkeys):
+        ...         self.calls.append(('fwmkeys', prefix, maxkeys))
+        ...         return sorted(self.keys)[:maxkeys]
+        ...     def multi_vsiz(self, keys):
+        ...         self.calls.append(('multi_vsiz', sorted(keys)))
+        ...         return [key in self.keys and 1 or None for key in keys]
+        >>> t = PyTyrant(StubTyrant(set(['a', 'b', 'c'])))
+        >>> t.multi_contains(['c', 'x', 'a', 'c'])
+        [True, False, True, True]
+        >>> t.t.calls
+        [('multi_vsiz', ['a', 'c', 'x'])]
+        >>> bloom = t.build_bloom()
+        >>> t.t.calls[-1]
+        ('fwmkeys', '', 1027)
+        >>> t.multi_contains(['c', 'x', 'a', 'c'])
+        [True, False, True, True]
+        >>> t.t.calls[-1]
+        ('multi_vsiz', ['a', 'c'])
+        """
+        if not isinstance(keys, (list, tuple)):
+            keys = list(keys)
+        if self.bloom is not None:
+            bloom = self.bloom
+            candidates = set(k for k in keys if k in bloom)
+        else:
+            candidates = set(keys)
+        candidates = list(candidates)
+        sizes = self.t.multi_vsiz(candidates)
+        found = set(k for k, size in itertools.izip(candidates, sizes)
+            if size is not None)
+        return [k in found for k in keys]
+
+    def build_bloom(self, error_rate=0.01, capacity=None):
+        """Rebuild the client-side Bloom filter from a scan of all keys.
+
+        Keys written through this object are added to the filter as they
+        are stored, but writes from other clients are only picked up by
+        rebuilding it. All keys are fetched with a single fwmkeys call, so
+        they must fit in memory. Returns the new BloomFilter.
+        """
+        maxkeys = len(self) + PIPELINE_SIZE
+        while True:
+            keys = self.t.fwmkeys('', maxkeys)
+            if len(keys) < maxkeys:
+                break
+            # Keys were added since len(), fetch them all
+            maxkeys *= 2
+        if capacity is None:
+            capacity = len(keys)
+        bloom = BloomFilter(capacity, error_rate)
+        for key in keys:
+            bloom.add(key)
+        self.bloom = bloom
+        return bloom
+
+    def drop_bloom(self):
+        self.bloom = None
+
+    def _bloom_add(self, key):
+        if self.bloom is not None:
+            self.bloom.add(key)
+
+    def _encode_many(self, values):
+        if self.serializer is None:
+            return values
+        return self.serializer.dumps_many(values)
+
+    def _decode_many(self, datas):
+        if self.serializer is None:
+            return datas
+        return self.serializer.loads_many(datas)
+
+    def _encode(self, value):
+        if self.serializer is None:
+            return value
+        return self.serializer.dumps(value)
+
+    def _decode(self, data):
+        if self.serializer is None:
+            return data
+        return self.serializer.loads(data)
+
     def setdefault(self, key, value):
         try:
-            self.t.putkeep(key, value)
+            self.t.putkeep(key, self._encode(value))
         except TyrantError:
             return self[key]
+        self._bloom_add(key)
         return value
 
     def __setitem__(self, key, value):
-        self.t.put(key, value)
+        self.t.put(key, self._encode(value))
+        self._bloom_add(key)
 
     def __getitem__(self, key):
+        if self._get_coalescer is not None:
+            return self._get_coalescer.get(key)
         try:
-            return self.t.get(key)
+            data = self.t.get(key)
         except TyrantError:
             raise KeyError(key)
+        return self._decode(data)
 
     def __delitem__(self, key):
         try:
@@ -328,20 +1220,20 @@ class PyTyrant(object, UserDict.DictMixin):
         opts = (no_update_log and RDBMONOULOG or 0)
         if not isinstance(keys, (list, tuple)):
             keys = list(keys)
-        rval = self.t.misc("getlist", opts, keys)
-        if len(rval) <= len(keys):
-            # 1.1.10 protocol, may return invalid results
-            if len(rval) < len(keys):
-                raise KeyError("Missing a result, unusable response in 1.1.10")
-            return rval
-        # 1.1.11 protocol returns interleaved key, value list
-        d = list_to_dict(rval)
+        records = _getlist_records(keys, self.t.misc("getlist", opts, keys))
+        d = dict(itertools.izip(
+            records.keys(), self._decode_records(records.values())))
         return map(d.get, keys)
 
     def multi_set(self, items, no_update_log=False):
         opts = (no_update_log and RDBMONOULOG or 0)
-        lst = []
+        keys, values = [], []
         for k, v in items:
+            keys.append(k)
+            values.append(v)
+            self._bloom_add(k)
+        lst = []
+        for k, v in itertools.izip(keys, self._encode_many(values)):
             lst.extend((k, v))
         self.t.misc("putlist", opts, lst)
 
@@ -351,7 +1243,110 @@ class PyTyrant(object, UserDict.DictMixin):
             (global_locking and RDBXOLCKGLB or 0))
         return self.t.ext(func, opts, key, value)
 
+    def call_func_many(self, func, items, record_locking=False,
+            global_locking=False, packed=False, batch_size=PIPELINE_SIZE,
+            connections=()):
+        """Call func(key, value) for each (key, value) in items.
+
+        Returns a list holding the result of each call, or the exception
+        for the calls that failed: a TyrantError, or the socket.error for
+        calls cut off by a connection failure (see Tyrant.multi_ext). Calls
+        are pipelined, and batches of batch_size items are spread
+        concurrently over this object's connection and any extra Tyrant
+        connections given.
+
+        Each batch is its own command, so a timeout applies to one batch
+        and a connection failure only cuts off the rest of its batch.
+
+        If packed is true each batch is sent to func in a single call, with
+        the number of items as key and the keys and values joined with NUL
+        bytes as value, so they must not contain NUL bytes themselves. func
+        must then return the results joined with NUL bytes, and a failed
+        call fails every item in the batch. The key of a packed call isn't
+        a record, so packed can't be combined with record_locking.
+
+        >>> class StubTyrant(object):
+        ...     # 'upper' uppercases each value, 'packed_upper' each packed value
+        ...     def __init__(self):
+        ...         self.calls = []
+        ...         self.fail = False
+        ...     def multi_ext(self, func, opts, items):
+        ...         self.calls.append([key for key, value in items])
+        ...         if func == 'packed_upper':
+        ...             results = ['\\x00'.join(value.split('\\x00')[1::2]).upper()
+        ...                 for key, value in items]
+        ...         else:
+        ...             results = [value.upper() for key, value in items]
+        ...         if self.fail:
+        ...             # The connection drops before the last reply
+        ...             results[-1] = TyrantConnectionError(
+        ...                 'Connection closed by server')
+        ...         return results
+        >>> a, b = StubTyrant(), StubTyrant()
+        >>> t = PyTyrant(a)
+        >>> items = [('k%d' % i, 'v%d' % i) for i in range(5)]
+        >>> t.call_func_many('upper', items, batch_size=2, connections=[b])
+        ['V0', 'V1', 'V2', 'V3', 'V4']
+        >>> a.calls, b.calls
+        ([['k0', 'k1'], ['k4']], [['k2', 'k3']])
+        >>> a.calls, b.calls = [], []
+        >>> t.call_func_many('packed_upper', items, packed=True, batch_size=2,
+        ...     connections=[b])
+        ['V0', 'V1', 'V2', 'V3', 'V4']
+        >>> a.calls, b.calls
+        ([['2'], ['1']], [['2']])
+        >>> b.fail = True
+        >>> t.call_func_many('upper', items, batch_size=2, connections=[b])
+        ['V0', 'V1', 'V2', TyrantConnectionError('Connection closed by server',), 'V4']
+        >>> t.call_func_many('packed_upper', items, packed=True, batch_size=2,
+        ...     connections=[b])
+        ... # doctest: +NORMALIZE_WHITESPACE
+        ['V0', 'V1', TyrantConnectionError('Connection closed by server',),
+         TyrantConnectionError('Connection closed by server',), 'V4']
+        >>> t.call_func_many('packed_upper', items, packed=True,
+        ...     record_locking=True)
+        Traceback (most recent call last):
+        ...
+        ValueError: Packed calls cannot use record_locking
+        """
+        if packed and record_locking:
+            raise ValueError('Packed calls cannot use record_locking')
+        opts = (
+            (record_locking and RDBXOLCKREC or 0) |
+            (global_locking and RDBXOLCKGLB or 0))
+        if not isinstance(items, (list, tuple)):
+            items = list(items)
+        if packed:
+            for key, value in items:
+                if '\x00' in key or '\x00' in value:
+                    raise ValueError('Packed keys and values cannot contain '
+                        'NUL bytes, found one in the item for %r' % (key,))
+        tyrants = [self.t] + list(connections)
+        batches = [items[i:i + batch_size]
+            for i in xrange(0, len(items), batch_size)]
+        shares = [(t, batches[i::len(tyrants)])
+            for i, t in enumerate(tyrants) if batches[i::len(tyrants)]]
+
+        def run(t, share):
+            results = []
+            for batch in share:
+                if packed:
+                    call = (str(len(batch)), '\x00'.join(itertools.chain(*batch)))
+                    results.append(_unpack_results(
+                        t.multi_ext(func, opts, [call])[0], len(batch)))
+                else:
+                    results.append(t.multi_ext(func, opts, batch))
+            return results
+
+        per_tyrant = _parallel(run, shares)
+        rval = []
+        for i in xrange(len(batches)):
+            rval.extend(per_tyrant[i % len(tyrants)][i // len(tyrants)])
+        return rval
+
     def get_size(self, key):
+        if self._size_coalescer is not None:
+            return self._size_coalescer.get(key)
         try:
             return self.t.vsiz(key)
         except TyrantError:
@@ -366,10 +1361,13 @@ class PyTyrant(object, UserDict.DictMixin):
         return self.t.fwmkeys(prefix, maxkeys)
 
     def concat(self, key, value, width=None):
+        if self.serializer is not None:
+            raise ValueError('Cannot concat to serialized values')
         if width is None:
             self.t.putcat(key, value)
         else:
             self.t.putshl(key, value, width)
+        self._bloom_add(key)
 
     def sync(self):
         self.t.sync()
@@ -415,12 +1413,10 @@ class Query(object):
                 limit = k.stop - (k.start or 0)
             else:
                 limit = -1
-            condition = '\x00'.join(('setlimit', str(limit), str(k.start or 0)))
-            resp = self.ptt.t.misc('search', 0, self.conditions + [condition])
+            resp = self._search(limit, k.start or 0)
             return k.step and list(resp)[::k.step] or resp
 
-        condition = '\x00'.join(('setlimit', str(1), str(k)))
-        resp = self.ptt.t.misc('search', 0, self.conditions + [condition])
+        resp = self._search(1, k)
         if not resp:
             return None
         else:
@@ -478,58 +1474,274 @@ class Query(object):
         q.__dict__.update(kwargs)
         return q
     
+    def _search(self, limit=None, offset=0):
+        conditions = self.conditions
+        if limit is not None:
+            condition = '\x00'.join(('setlimit', str(limit), str(offset)))
+            conditions = conditions + [condition]
+        return self.ptt.t.misc('search', 0, conditions)
+
     def _get_results(self):
         if self._result_cache is None:
-            self._result_cache = self.ptt.t.misc('search', 0, self.conditions)
+            self._result_cache = self._search()
         return self._result_cache
 
 
+def _sort_value(value, direction):
+    if direction in (RDBQONUMASC, RDBQONUMDESC):
+        # Non-numeric columns sort as 0, like the server does
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0.0
+    if value is None:
+        return ''
+    return value
+
+
+class ShardedQuery(Query):
+    """
+    Query run concurrently against every shard in a list of PyTableTyrant
+    instances, with the same filter and ordering interface as Query
+
+    The ordered key lists returned by each shard are merged client-side,
+    which needs the ordering column of every returned record. The
+    protocol can't fetch single columns, so each shard's whole matching
+    records are fetched with a second getlist. Slices are pushed down to
+    the shards as limits so only the first stop results of each shard are
+    fetched. An ordered query that is not sliced fetches every matching
+    record. Records deleted between the search and the getlist are left
+    out of the results.
+
+    >>> class StubTyrant(object):
+    ...     def __init__(self, rows):
+    ...         self.rows = rows
+    ...         self.deleted = set()
+    ...         self.calls = []
+    ...     def misc(self, func, opts, args):
+    ...         self.calls.append((func, list(args)))
+    ...         if func == 'getlist':
+    ...             return list(itertools.chain(*[(key, 'n\\x00' + self.rows[key])
+    ...                 for key in args if key not in self.deleted]))
+    ...         keys = sorted(self.rows, key=lambda key: int(self.rows[key]))
+    ...         for condition in args:
+    ...             parts = condition.split('\\x00')
+    ...             if parts[0] == 'setorder' and parts[2] == str(RDBQONUMDESC):
+    ...                 keys.reverse()
+    ...             elif parts[0] == 'setlimit':
+    ...                 keys = keys[int(parts[2]):int(parts[2]) + int(parts[1])]
+    ...         return keys
+    >>> a = PyTableTyrant(StubTyrant({'a1': '1', 'a5': '5', 'a9': '9'}))
+    >>> b = PyTableTyrant(StubTyrant({'b2': '2', 'b3': '3', 'b8': '8'}))
+    >>> q = ShardedQuery([a, b]).order_by_num('n')
+    >>> q[1:3]
+    ['b2', 'b3']
+    >>> b.t.calls
+    [('search', ['setorder\\x00n\\x002', 'setlimit\\x003\\x000']), ('getlist', ['b2', 'b3', 'b8'])]
+    >>> list(q)
+    ['a1', 'b2', 'b3', 'a5', 'b8', 'a9']
+    >>> desc = ShardedQuery([a, b]).order_by_num('-n')
+    >>> desc[0]
+    'a9'
+    >>> a.t.calls[-2]
+    ('search', ['setorder\\x00n\\x003', 'setlimit\\x001\\x000'])
+    >>> list(desc)
+    ['a9', 'b8', 'a5', 'b3', 'b2', 'a1']
+    >>> a.t.deleted.add('a5')
+    >>> list(ShardedQuery([a, b]).order_by_num('n'))
+    ['a1', 'b2', 'b3', 'b8', 'a9']
+    """
+    def __init__(self, shards):
+        self.shards = list(shards)
+        self.conditions = []
+        self.order = None
+        self._owners = {}
+        self._result_cache = None
+
+    def items(self):
+        keys = list(self)
+        byshard = {}
+        for key in keys:
+            byshard.setdefault(self._owners[key], []).append(key)
+        shards = byshard.keys()
+        values = {}
+        results = _parallel(lambda shard: shard.multi_get(byshard[shard]),
+            [(shard,) for shard in shards])
+        for shard, rows in itertools.izip(shards, results):
+            values.update(itertools.izip(byshard[shard], rows))
+        return [values[key] for key in keys]
+
+    def order_by_num(self, field):
+        q = super(ShardedQuery, self).order_by_num(field)
+        if field.startswith('-'):
+            q.order = (field[1:], RDBQONUMDESC)
+        else:
+            q.order = (field, RDBQONUMASC)
+        return q
+
+    def order_by_str(self, field):
+        q = super(ShardedQuery, self).order_by_str(field)
+        if field.startswith('-'):
+            q.order = (field[1:], RDBQOSTRDESC)
+        else:
+            q.order = (field, RDBQOSTRASC)
+        return q
+
+    def _clone(self, klass=None, **kwargs):
+        if klass is None:
+            klass = self.__class__
+        q = klass(self.shards)
+        q.conditions = self.conditions[:]
+        q.order = self.order
+        q.__dict__.update(kwargs)
+        return q
+
+    def _search_shard(self, shard, conditions):
+        keys = shard.t.misc('search', 0, conditions)
+        if self.order is None or not keys:
+            return keys
+        # Fetch the ordering column so the shards' results can be merged
+        field, direction = self.order
+        rval = shard.t.misc('getlist', 0, keys)
+        records = dict((rval[i], rval[i + 1]) for i in xrange(0, len(rval), 2))
+        rows = []
+        for key in keys:
+            if key not in records:
+                # Deleted since the search, it has no value to merge by
+                continue
+            value = None
+            record = records[key]
+            if record:
+                value = shard._decode_columns(record.split('\x00')).get(field)
+            rows.append((_sort_value(value, direction), key))
+        return rows
+
+    def _merge(self, results):
+        if self.order is None:
+            return list(itertools.chain(*results))
+        if self.order[1] in (RDBQOSTRASC, RDBQONUMASC):
+            return [key for value, key in heapq.merge(*results)]
+        # heapq.merge only merges ascending sequences
+        merged = [key for value, key in
+            heapq.merge(*[reversed(rows) for rows in results])]
+        merged.reverse()
+        return merged
+
+    def _search(self, limit=None, offset=0):
+        conditions = self.conditions
+        if limit is not None and limit >= 0:
+            # Each shard has to supply everything up to the end of the slice
+            condition = '\x00'.join(('setlimit', str(offset + limit), '0'))
+            conditions = conditions + [condition]
+        results = _parallel(self._search_shard,
+            [(shard, conditions) for shard in self.shards])
+        for shard, rows in itertools.izip(self.shards, results):
+            if self.order is not None:
+                rows = [key for value, key in rows]
+            self._owners.update(itertools.izip(rows, itertools.repeat(shard)))
+        keys = self._merge(results)
+        if limit is None:
+            return keys
+        if limit < 0:
+            return keys[offset:]
+        return keys[offset:offset + limit]
+
+
 class PyTableTyrant(PyTyrant):
     """
     Dict-like proxy for a Table-based Tyrant instance
+
+    With a serializer, string and number columns are still stored untagged
+    so the server can filter and order on them. Unicode strings are stored
+    as UTF-8 and numbers as their decimal string, and both are read back
+    as byte strings, as the server sees them. Only other values are tagged
+    by the serializer, and those can't be used in queries.
+
+    >>> pt = PyTableTyrant(None, serializer=JSONSerializer())
+    >>> pt._encode_columns({'name': 'bob'})
+    ['name', 'bob']
+    >>> pt._encode_columns({'name': u'b\\xf6b'})
+    ['name', 'b\\xc3\\xb6b']
+    >>> pt._encode_columns({'age': 42})
+    ['age', '42']
+    >>> pt._encode_columns({'tags': ['a', 'b']})
+    ['tags', '\\x04["a","b"]']
+    >>> pt._decode_columns(['tags', '\\x04["a","b"]'])
+    {'tags': [u'a', u'b']}
     """
+    def __init__(self, t, serializer=None):
+        if serializer is not None and serializer.binary:
+            raise ValueError("%s output can't be stored in table columns"
+                % (serializer.name,))
+        super(PyTableTyrant, self).__init__(t, serializer=serializer)
+
+    def _encode_columns(self, dct):
+        if self.serializer is None:
+            return dict_to_list(dct)
+        lst = []
+        tagged = []
+        for col, value in dct.iteritems():
+            if isinstance(value, str):
+                value = _escape(value)
+            elif isinstance(value, unicode):
+                value = _escape(value.encode('utf-8'))
+            elif isinstance(value, bool):
+                tagged.append(len(lst) + 1)
+            elif isinstance(value, (int, long)):
+                value = str(value)
+            elif isinstance(value, float):
+                value = repr(value)
+            else:
+                tagged.append(len(lst) + 1)
+            lst.extend((col, value))
+        if tagged:
+            values = self._encode_many([lst[i] for i in tagged])
+            for i, value in itertools.izip(tagged, values):
+                lst[i] = value
+        return lst
+
+    def _decode_columns(self, lst):
+        if self.serializer is None:
+            return list_to_dict(lst)
+        return dict(itertools.izip(lst[::2], self._decode_many(lst[1::2])))
+
+    def _decode_records(self, datas):
+        return [self._decode_columns(data.split('\x00')) for data in datas]
+
     def setdefault(self, key, value, no_update_log=False):
         opts = (no_update_log and RDBMONOULOG or 0)
         try:
-            self.t.misc('putkeep', opts, [key] + dict_to_list(value))
+            self.t.misc('putkeep', opts, [key] + self._encode_columns(value))
         except TyrantError:
             return self[key]
+        self._bloom_add(key)
         return value
 
     def __setitem__(self, key, value):
-        self.t.misc('put', 0, [key] + dict_to_list(value))
+        self.t.misc('put', 0, [key] + self._encode_columns(value))
+        self._bloom_add(key)
 
     def __getitem__(self, key):
+        if self._get_coalescer is not None:
+            return self._get_coalescer.get(key)
         try:
-            return list_to_dict(self.t.misc('get', 0, (key,)))
+            return self._decode_columns(self.t.misc('get', 0, (key,)))
         except TyrantError:
             raise KeyError(key)
 
-    def multi_get(self, keys, no_update_log=False):
-        opts = (no_update_log and RDBMONOULOG or 0)
-        if not isinstance(keys, (list, tuple)):
-            keys = list(keys)
-        rval = self.t.misc("getlist", opts, keys)
-        if len(rval) <= len(keys):
-            # 1.1.10 protocol, may return invalid results
-            if len(rval) < len(keys):
-                raise KeyError("Missing a result, unusable response in 1.1.10")
-            return list_to_dict(rval.split('\x00'))
-        # 1.1.11 protocol returns interleaved key, value list
-        d = dict((rval[i], rval[i + 1]) for i in xrange(0, len(rval), 2))
-        return [list_to_dict(d.get(i).split('\x00')) for i in keys]
-
     def multi_set(self, items, no_update_log=False):
         opts = (no_update_log and RDBMONOULOG or 0)
         lst = []
         for k, v in items:
-            lst.extend((k, '\x00'.join(dict_to_list(v))))
+            lst.extend((k, '\x00'.join(self._encode_columns(v))))
+            self._bloom_add(k)
         self.t.misc("putlist", opts, lst)
 
     def concat(self, key, value, width=None, no_update_log=False):
         opts = (no_update_log and RDBMONOULOG or 0)
         if width is None:
-            self.t.misc('putcat', opts, ([key] + dict_to_list(value)))
+            self.t.misc('putcat', opts, ([key] + self._encode_columns(value)))
+            self._bloom_add(key)
         else:
             raise ValueError('Cannot concat with a width on a table database')
     
@@ -539,31 +1751,174 @@ class PyTableTyrant(PyTyrant):
 
 
 class Tyrant(object):
+    """
+    Raw Tyrant protocol connection
+
+    timeout bounds how long any single command may take, and deadline
+    bounds a group of commands. A command that times out or loses the
+    connection raises a socket.error and closes the connection, which is
+    reopened on the next command. Commands that only read are retried once
+    on a fresh connection first. If a CircuitBreaker is given, commands
+    fail fast with CircuitOpenError while it is open, and each command
+    that fails counts as one failure however many attempts it made.
+
+    >>> class ScriptedTyrant(Tyrant):
+    ...     # Each connection replays the next canned reply, then hangs up
+    ...     def __init__(self, replies, **kw):
+    ...         Tyrant.__init__(self, None, host='stub', **kw)
+    ...         self.replies = replies
+    ...         self.peers = []
+    ...     def _connect(self, timeout):
+    ...         ours, theirs = socket.socketpair()
+    ...         theirs.sendall(self.replies.pop(0))
+    ...         theirs.shutdown(socket.SHUT_WR)
+    ...         self.peers.append(theirs)
+    ...         self.sock = DeadlineSocket(ours)
+    >>> t = ScriptedTyrant(['', '\\x00' + struct.pack('>I', 1) + 'v'])
+    >>> t.get('key')
+    'v'
+    >>> len(t.peers)
+    2
+    >>> t = ScriptedTyrant(['', '\\x00'])
+    >>> t.put('key', 'v')
+    Traceback (most recent call last):
+    ...
+    TyrantConnectionError: Connection closed by server
+    >>> len(t.peers), t.sock
+    (1, None)
+    >>> breaker = CircuitBreaker(failure_threshold=2)
+    >>> t = ScriptedTyrant(['', ''], breaker=breaker)
+    >>> t.get('key')
+    Traceback (most recent call last):
+    ...
+    TyrantConnectionError: Connection closed by server
+    >>> breaker.failures, breaker.is_open()
+    (1, False)
+
+    Pipelined calls that fail part way through keep the results they got:
+
+    >>> t = ScriptedTyrant(['\\x00' + struct.pack('>I', 2) + 'ok\\x01'])
+    >>> t.multi_ext('echo', 0, [('a', 'ok'), ('b', 'x'), ('c', 'y')])
+    ['ok', TyrantError(1,), TyrantConnectionError('Connection closed by server',)]
+    """
     @classmethod
-    def open(cls, host='127.0.0.1', port=DEFAULT_PORT):
-        sock = socket.socket()
-        sock.connect((host, port))
-        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-        return cls(sock)
-
-    def __init__(self, sock):
+    def open(cls, host='127.0.0.1', port=DEFAULT_PORT, timeout=None,
+            breaker=None):
+        t = cls(None, host=host, port=port, timeout=timeout, breaker=breaker)
+        t.connect()
+        return t
+
+    def __init__(self, sock, host=None, port=DEFAULT_PORT, timeout=None,
+            breaker=None):
+        if sock is not None and not isinstance(sock, DeadlineSocket):
+            sock = DeadlineSocket(sock)
         self.sock = sock
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.breaker = breaker
+        self._deadline = None
+
+    def connect(self):
+        """(Re)open the connection to host:port
+        """
+        self._connect(self.timeout)
+
+    def _connect(self, timeout):
+        if self.host is None:
+            raise TyrantConnectionError('Not connected, no host to reconnect to')
+        self.close()
+        sock = socket.socket()
+        try:
+            sock.settimeout(timeout)
+            sock.connect((self.host, self.port))
+            sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        except:
+            sock.close()
+            raise
+        self.sock = DeadlineSocket(sock)
 
     def close(self):
-        self.sock.close()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    @contextlib.contextmanager
+    def deadline(self, seconds):
+        """Context manager that requires all commands in the block to
+        finish within seconds, raising socket.timeout otherwise
+        """
+        previous = self._deadline
+        deadline = time.time() + seconds
+        if previous is not None:
+            deadline = min(deadline, previous)
+        self._deadline = deadline
+        try:
+            yield
+        finally:
+            self._deadline = previous
+
+    def _call(self, idempotent, func, *args, **kw):
+        deadline = self._deadline
+        if self.timeout is not None:
+            timeout_deadline = time.time() + self.timeout
+            if deadline is None or timeout_deadline < deadline:
+                deadline = timeout_deadline
+        breaker = self.breaker
+        if breaker is not None:
+            breaker.before_call()
+        retries = idempotent and 1 or 0
+        while True:
+            try:
+                if self.sock is None:
+                    timeout = None
+                    if deadline is not None:
+                        timeout = deadline - time.time()
+                        if timeout <= 0:
+                            raise socket.timeout('Deadline exceeded')
+                    self._connect(timeout)
+                sock = self.sock
+                if (deadline is not None or sock.deadline is not None
+                        or not sock.blocking):
+                    sock.set_deadline(deadline)
+                rval = func(*args, **kw)
+            except TyrantError:
+                # The server answered, so the connection is healthy
+                if breaker is not None:
+                    breaker.success()
+                raise
+            except socket.error:
+                # The stream is in an unknown state, don't reuse it
+                self.close()
+                if (retries and self.host is not None
+                        and (deadline is None or time.time() < deadline)):
+                    retries -= 1
+                    continue
+                if breaker is not None:
+                    breaker.failure()
+                raise
+            except:
+                self.close()
+                raise
+            if breaker is not None:
+                breaker.success()
+            return rval
 
+    @_command()
     def put(self, key, value):
         """Unconditionally set key to value
         """
         socksend(self.sock, _t2(C.put, key, value))
         socksuccess(self.sock)
 
+    @_command()
     def putkeep(self, key, value):
         """Set key to value if key does not already exist
         """
         socksend(self.sock, _t2(C.putkeep, key, value))
         socksuccess(self.sock)
 
+    @_command()
     def putcat(self, key, value):
         """Append value to the existing value for key, or set key to
         value if it does not already exist
@@ -571,6 +1926,7 @@ class Tyrant(object):
         socksend(self.sock, _t2(C.putcat, key, value))
         socksuccess(self.sock)
 
+    @_command()
     def putshl(self, key, value, width):
         """Equivalent to::
 
@@ -580,17 +1936,20 @@ class Tyrant(object):
         socksend(self.sock, _t2W(C.putshl, key, value, width))
         socksuccess(self.sock)
 
+    @_command()
     def putnr(self, key, value):
         """Set key to value without waiting for a server response
         """
         socksend(self.sock, _t2(C.putnr, key, value))
 
+    @_command()
     def out(self, key):
         """Remove key from server
         """
         socksend(self.sock, _t1(C.out, key))
         socksuccess(self.sock)
 
+    @_command(idempotent=True)
     def get(self, key):
         """Get the value of a key from the server
         """
@@ -606,11 +1965,13 @@ class Tyrant(object):
             k, v = sockstrpair(self.sock)
             yield k, v
 
+    @_command(idempotent=True)
     def mget(self, klst):
         """Get key,value pairs from the server for the given list of keys
         """
         return list(self._mget(klst))
 
+    @_command(idempotent=True)
     def vsiz(self, key):
         """Get the size of a value for key
         """
@@ -618,12 +1979,40 @@ class Tyrant(object):
         socksuccess(self.sock)
         return socklen(self.sock)
 
+    def multi_vsiz(self, klst):
+        """Get the sizes of the values for a list of keys, pipelining the
+        requests. The size is None for keys that do not exist.
+
+        Each chunk of PIPELINE_SIZE keys is a separate command, so the
+        timeout applies to each chunk rather than to the whole list.
+        """
+        sizes = []
+        for i in xrange(0, len(klst), PIPELINE_SIZE):
+            sizes.extend(self._call(True, self._multi_vsiz,
+                klst[i:i + PIPELINE_SIZE]))
+        return sizes
+
+    def _multi_vsiz(self, chunk):
+        lst = []
+        for key in chunk:
+            lst.extend(_t1(C.vsiz, key))
+        socksend(self.sock, lst)
+        sizes = []
+        for key in chunk:
+            if ord(sockrecv(self.sock, 1)):
+                sizes.append(None)
+            else:
+                sizes.append(socklen(self.sock))
+        return sizes
+
+    @_command()
     def iterinit(self):
         """Begin iteration over all keys of the database
         """
         socksend(self.sock, _t0(C.iterinit))
         socksuccess(self.sock)
 
+    @_command()
     def iternext(self):
         """Get the next key after iterinit
         """
@@ -638,16 +2027,19 @@ class Tyrant(object):
         for i in xrange(numkeys):
             yield sockstr(self.sock)
 
+    @_command(idempotent=True)
     def fwmkeys(self, prefix, maxkeys):
         """Get up to the first maxkeys starting with prefix
         """
         return list(self._fwmkeys(prefix, maxkeys))
 
+    @_command()
     def addint(self, key, num):
         socksend(self.sock, _t1M(C.addint, key, num))
         socksuccess(self.sock)
         return socklen(self.sock)
 
+    @_command()
     def adddouble(self, key, num):
         fracpart, intpart = math.modf(num)
         fracpart, intpart = int(fracpart * 1e12), int(intpart)
@@ -655,6 +2047,7 @@ class Tyrant(object):
         socksuccess(self.sock)
         return sockdouble(self.sock)
 
+    @_command()
     def ext(self, func, opts, key, value):
         # tcrdbext opts are RDBXOLCKREC, RDBXOLCKGLB
         """Call func(key, value) with opts
@@ -665,36 +2058,75 @@ class Tyrant(object):
         socksuccess(self.sock)
         return sockstr(self.sock)
 
+    def multi_ext(self, func, opts, items):
+        """Call func(key, value) with opts for each (key, value) in items,
+        pipelining the requests. Returns a list holding the result of each
+        call, or a TyrantError for the calls that failed.
+
+        Each chunk of PIPELINE_SIZE calls is a separate command. If the
+        connection fails part way through, the results read so far are kept
+        and every remaining call gets the socket.error instead. Those calls
+        may or may not have run on the server.
+        """
+        results = []
+        for i in xrange(0, len(items), PIPELINE_SIZE):
+            try:
+                self._call(False, self._multi_ext, func, opts,
+                    items[i:i + PIPELINE_SIZE], results)
+            except socket.error:
+                error = sys.exc_info()[1]
+                results.extend([error] * (len(items) - len(results)))
+                break
+        return results
+
+    def _multi_ext(self, func, opts, chunk, results):
+        lst = []
+        for key, value in chunk:
+            lst.extend(_t3F(C.ext, func, opts, key, value))
+        socksend(self.sock, lst)
+        for item in chunk:
+            fail_code = ord(sockrecv(self.sock, 1))
+            if fail_code:
+                results.append(TyrantError(fail_code))
+            else:
+                results.append(sockstr(self.sock))
+
+    @_command()
     def sync(self):
         """Synchronize the database
         """
         socksend(self.sock, _t0(C.sync))
         socksuccess(self.sock)
 
+    @_command()
     def vanish(self):
         """Remove all records
         """
         socksend(self.sock, _t0(C.vanish))
         socksuccess(self.sock)
 
+    @_command()
     def copy(self, path):
         """Hot-copy the database to path
         """
         socksend(self.sock, _t1(C.copy, path))
         socksuccess(self.sock)
 
+    @_command()
     def restore(self, path, msec):
         """Restore the database from path at timestamp (in msec)
         """
         socksend(self.sock, _t1R(C.copy, path, msec))
         socksuccess(self.sock)
 
+    @_command()
     def setmst(self, host, port):
         """Set master to host:port
         """
         socksend(self.sock, _t1M(C.setmst, host, port))
         socksuccess(self.sock)
 
+    @_command(idempotent=True)
     def rnum(self):
         """Get the number of records in the database
         """
@@ -702,6 +2134,7 @@ class Tyrant(object):
         socksuccess(self.sock)
         return socklong(self.sock)
 
+    @_command(idempotent=True)
     def size(self):
         """Get the size of the database
         """
@@ -709,6 +2142,7 @@ class Tyrant(object):
         socksuccess(self.sock)
         return socklong(self.sock)
 
+    @_command(idempotent=True)
     def stat(self):
         """Get some statistics about the database
         """
@@ -736,6 +2170,10 @@ class Tyrant(object):
 
         opts is a bitflag that can be RDBMONOULOG to prevent writing to the update log
         """
+        return self._call(func in IDEMPOTENT_MISC, self._misclist,
+            func, opts, args)
+
+    def _misclist(self, func, opts, args):
         return list(self._misc(func, opts, args))
 
 